@@ -2,36 +2,67 @@
 """
 Python Kernel Server for Jupyter-ish Notebook
 Provides a REST API backend for Python code execution with full Jupyter compatibility.
+
+The kernel namespace lives in this process, so run exactly one worker process; scale
+with threads instead, e.g. `gunicorn -w 1 --threads 8 kernel_server:app`.
 """
 
 import sys
+import ast
 import io
 import os
 import base64
-import traceback
+import codecs
 import json
 import time
 import threading
 import subprocess
+import signal
 import re
 import tempfile
 import shutil
+import stat
+import tokenize
 import uuid
+import functools
+import weakref
+import types
 from pathlib import Path
-from contextlib import redirect_stdout, redirect_stderr
+from collections import OrderedDict
+from concurrent.futures import Future
+from contextlib import contextmanager, redirect_stdout, redirect_stderr
 from typing import Any, Dict, List, Optional, Tuple
 from datetime import datetime
+from decimal import Decimal
 
-from flask import Flask, request, jsonify, send_file
+from flask import Flask, Response, request, jsonify, send_file
 from flask_cors import CORS
 
 app = Flask(__name__)
 CORS(app, resources={r"/*": {"origins": "*"}})
 
+# Let a fronting proxy (nginx/Apache X-Sendfile) serve send_file() responses from disk
+app.config['USE_X_SENDFILE'] = os.environ.get('USE_X_SENDFILE', '0') == '1'
+
+# Gzip responses (notebooks with embedded plots compress well); small payloads are sent as-is
+try:
+    from flask_compress import Compress
+    app.config['COMPRESS_MIN_SIZE'] = 4096
+    Compress(app)
+except ImportError:
+    pass
+
 # Notebook storage directory
 NOTEBOOKS_DIR = Path(os.environ.get('NOTEBOOKS_DIR', '/home/user/notebooks'))
 NOTEBOOKS_DIR.mkdir(parents=True, exist_ok=True)
 
+# Long-lived directory fd: per-notebook stat/open/unlink resolve names relative to it
+# (fstatat/openat/unlinkat) instead of walking the full path on every request
+if {os.open, os.stat, os.unlink} <= os.supports_dir_fd:
+    NOTEBOOKS_DIR_FD = os.open(NOTEBOOKS_DIR, os.O_RDONLY | getattr(os, 'O_DIRECTORY', 0))
+else:
+    NOTEBOOKS_DIR_FD = None
+
 # Working directory for kernel
 WORKING_DIR = Path(os.environ.get('KERNEL_WORKING_DIR', '/home/user/workspace'))
 WORKING_DIR.mkdir(parents=True, exist_ok=True)
@@ -41,46 +72,53 @@ os.chdir(WORKING_DIR)
 class KernelState:
     """Global kernel state management"""
     
+    # Namespace entries hidden from %who/%whos
+    SKIP_NAMES = frozenset({'__builtins__', '__name__', '__doc__', '__package__', '__file__',
+                            'np', 'pd', 'plt', 'In', 'Out'})
+    # The variable inspector additionally hides common helper modules
+    INSPECTOR_SKIP_NAMES = SKIP_NAMES | frozenset({'sys', 'io', 'os', 'base64', 'matplotlib',
+                                                   'json', 'numpy', 'pandas'})
+    
     def __init__(self):
         self.globals: Dict[str, Any] = {}
         self.execution_count = 0
         self.is_interrupted = False
         self._lock = threading.Lock()
+        # Held by the running cell only, so /restart never waits behind it
+        self._exec_lock = threading.Lock()
         self.working_dir = WORKING_DIR
         self._init_globals()
     
     def _init_globals(self):
         """Initialize global namespace - mimics Jupyter's behavior"""
-        self.globals = {
-            '__builtins__': __builtins__,
-            '__name__': '__main__',  # This makes if __name__ == "__main__" work!
-            '__doc__': None,
-            '__package__': None,
-            '__file__': '<ipython-input>',
-        }
-        # Pre-import common modules into namespace
-        try:
-            import numpy as np
-            self.globals['np'] = np
-        except ImportError:
-            pass
-        try:
-            import pandas as pd
-            self.globals['pd'] = pd
-        except ImportError:
-            pass
+        self.globals = _BASE_GLOBALS.copy()
     
     def reset(self):
         """Reset kernel state"""
         with self._lock:
+            # Cached timeit.Timers are keyed by id() of the old namespace
+            _TIMEIT_CACHE.clear()
             self._init_globals()
             self.execution_count = 0
             self.is_interrupted = False
     
+    @contextmanager
+    def executing(self):
+        """Run one cell at a time: stdout/stderr redirection and the cwd are process-wide"""
+        with self._exec_lock:
+            yield
+    
     def interrupt(self):
         """Set interrupt flag"""
         self.is_interrupted = True
     
+    def user_items(self, skip: frozenset = SKIP_NAMES) -> List[Tuple[str, Any]]:
+        """(name, value) pairs for user-defined globals, in a single pass"""
+        # list() snapshots the dict in one step, so a cell running concurrently can't
+        # change its size mid-iteration
+        return [(name, value) for name, value in list(self.globals.items())
+                if not name.startswith('_') and name not in skip]
+    
     def set_working_dir(self, path: str):
         """Change working directory"""
         new_dir = Path(path).expanduser().resolve()
@@ -91,8 +129,6 @@ class KernelState:
         return False
 
 
-kernel = KernelState()
-
 # Check available features
 matplotlib_available = False
 try:
@@ -117,21 +153,114 @@ try:
 except ImportError:
     pass
 
+orjson_available = False
+try:
+    import orjson
+    orjson_available = True
+except ImportError:
+    orjson = None
+
+zstandard_available = False
+try:
+    import zstandard
+    zstandard_available = True
+except ImportError:
+    zstandard = None
+
+pybase64_available = False
+try:
+    import pybase64
+    pybase64_available = True
+except ImportError:
+    pybase64 = None
+
+
+def b64encode_str(data) -> str:
+    """Base64-encode bytes-like data to str (SIMD-accelerated pybase64 when available)"""
+    if pybase64_available:
+        return pybase64.b64encode_as_string(data)
+    return base64.b64encode(data).decode('ascii')
+
+
+if orjson_available:
+    from flask.json.provider import JSONProvider
+    
+    class OrjsonProvider(JSONProvider):
+        """Flask JSON provider backed by orjson (used by jsonify and request.get_json)"""
+        
+        OPTIONS = orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY
+        
+        @staticmethod
+        def _default(o):
+            if hasattr(o, '__html__'):
+                return str(o.__html__())
+            if isinstance(o, Decimal):
+                return str(o)
+            raise TypeError(f"Object of type {type(o).__name__} is not JSON serializable")
+        
+        def dumps(self, obj, **kwargs) -> str:
+            return orjson.dumps(obj, default=self._default, option=self.OPTIONS).decode('utf-8')
+        
+        def loads(self, s, **kwargs):
+            return orjson.loads(s)
+        
+        def response(self, *args, **kwargs):
+            # Skip the str round-trip: orjson already produces the UTF-8 body
+            obj = self._prepare_response_obj(args, kwargs)
+            body = orjson.dumps(obj, default=self._default, option=self.OPTIONS)
+            return self._app.response_class(body, mimetype='application/json')
+    
+    app.json = OrjsonProvider(app)
+
+# (code, id(kernel.globals)) -> timeit.Timer for %timeit; cleared on kernel reset
+_TIMEIT_CACHE: Dict[Tuple[str, int], Any] = {}
+
+# Template for a fresh kernel namespace, copied on every reset
+_BASE_GLOBALS: Dict[str, Any] = {
+    '__builtins__': __builtins__,
+    '__name__': '__main__',  # This makes if __name__ == "__main__" work!
+    '__doc__': None,
+    '__package__': None,
+    '__file__': '<ipython-input>',
+}
+# Pre-import common modules into namespace
+if numpy_available:
+    _BASE_GLOBALS['np'] = np
+if pandas_available:
+    _BASE_GLOBALS['pd'] = pd
+
+kernel = KernelState()
+
+
+# bbox_inches='tight' costs an extra layout pass per figure; PLOT_TIGHT_BBOX=0 skips it
+PLOT_TIGHT_BBOX = os.environ.get('PLOT_TIGHT_BBOX', '1') != '0'
+
+_plot_local = threading.local()
+
 
 def get_all_plots_as_base64() -> List[str]:
     """Capture all matplotlib figures as base64 PNGs"""
     if not matplotlib_available or plt is None:
         return []
     
-    plots = []
     fig_nums = plt.get_fignums()
+    if not fig_nums:
+        return []
+    
+    # Reuse one PNG buffer per thread instead of allocating one per figure
+    buf = getattr(_plot_local, 'buf', None)
+    if buf is None:
+        buf = _plot_local.buf = io.BytesIO()
+    
+    plots = []
     for fig_num in fig_nums:
         fig = plt.figure(fig_num)
-        buf = io.BytesIO()
-        fig.savefig(buf, format='png', dpi=100, bbox_inches='tight',
-                    facecolor='white', edgecolor='none')
         buf.seek(0)
-        img_base64 = base64.b64encode(buf.read()).decode('utf-8')
+        buf.truncate()
+        fig.savefig(buf, format='png', dpi=100, bbox_inches='tight' if PLOT_TIGHT_BBOX else None,
+                    facecolor='white', edgecolor='none')
+        with buf.getbuffer() as view:
+            img_base64 = b64encode_str(view)
         plots.append(img_base64)
     
     plt.close('all')
@@ -144,6 +273,43 @@ def get_plot_as_base64() -> Optional[str]:
     return plots[0] if plots else None
 
 
+def run_command(cmd, timeout: float, shell: bool = False, cwd: Optional[str] = None) -> str:
+    """
+    Run a command and return its merged stdout/stderr.
+    Output is read line by line as it is produced instead of being buffered by
+    subprocess.run; raises subprocess.TimeoutExpired if the timeout elapses.
+    """
+    proc = subprocess.Popen(
+        cmd, shell=shell, cwd=cwd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+        text=True, bufsize=1, start_new_session=True
+    )
+    timed_out = threading.Event()
+    
+    def kill():
+        timed_out.set()
+        try:
+            # Kill the whole process group so shell children release the pipe too
+            os.killpg(proc.pid, signal.SIGKILL)
+        except (AttributeError, OSError):
+            proc.kill()
+    
+    timer = threading.Timer(timeout, kill)
+    timer.start()
+    chunks = []
+    try:
+        for line in proc.stdout:
+            chunks.append(line)
+        proc.wait()
+    finally:
+        timer.cancel()
+        proc.stdout.close()
+    
+    output = ''.join(chunks)
+    if timed_out.is_set():
+        raise subprocess.TimeoutExpired(cmd, timeout, output=output)
+    return output
+
+
 # ============== Magic Commands ==============
 
 class MagicHandler:
@@ -153,61 +319,23 @@ class MagicHandler:
     def handle_line_magic(magic: str, args: str, code_rest: str) -> Optional[Dict[str, Any]]:
         """Handle line magics (%magic)"""
         magic = magic.lower()
-        
-        if magic == 'pip':
-            return MagicHandler._pip(args)
-        elif magic == 'cd':
-            return MagicHandler._cd(args)
-        elif magic == 'pwd':
-            return MagicHandler._pwd()
-        elif magic == 'ls':
-            return MagicHandler._ls(args)
-        elif magic == 'cat':
-            return MagicHandler._cat(args)
-        elif magic == 'run':
-            return MagicHandler._run(args)
-        elif magic == 'load':
-            return MagicHandler._load(args)
-        elif magic == 'time':
+        if magic == 'time':
             return MagicHandler._time(code_rest)
-        elif magic == 'timeit':
+        if magic == 'timeit':
             return MagicHandler._timeit(args if args else code_rest)
-        elif magic == 'who':
-            return MagicHandler._who()
-        elif magic == 'whos':
-            return MagicHandler._whos()
-        elif magic == 'reset':
-            return MagicHandler._reset()
-        elif magic == 'env':
-            return MagicHandler._env(args)
-        elif magic == 'matplotlib':
-            return MagicHandler._matplotlib(args)
         
-        return None
+        handler = _LINE_MAGICS.get(magic)
+        return handler(args) if handler else None
     
     @staticmethod
     def handle_cell_magic(magic: str, args: str, body: str) -> Optional[Dict[str, Any]]:
         """Handle cell magics (%%magic)"""
         magic = magic.lower()
-        
-        if magic == 'bash' or magic == 'sh':
-            return MagicHandler._cell_bash(body)
-        elif magic == 'python' or magic == 'python3':
-            return MagicHandler._cell_python(body)
-        elif magic == 'writefile':
+        if magic == 'writefile':
             return MagicHandler._cell_writefile(args, body)
-        elif magic == 'time':
-            return MagicHandler._cell_time(body)
-        elif magic == 'timeit':
-            return MagicHandler._cell_timeit(body)
-        elif magic == 'html':
-            return MagicHandler._cell_html(body)
-        elif magic == 'javascript' or magic == 'js':
-            return MagicHandler._cell_javascript(body)
-        elif magic == 'capture':
-            return MagicHandler._cell_capture(body)
         
-        return None
+        handler = _CELL_MAGICS.get(magic)
+        return handler(body) if handler else None
     
     # Line magic implementations
     @staticmethod
@@ -215,8 +343,7 @@ class MagicHandler:
         """Handle %pip install"""
         try:
             cmd = [sys.executable, '-m', 'pip'] + args.split()
-            result = subprocess.run(cmd, capture_output=True, text=True, timeout=300)
-            output = result.stdout + result.stderr
+            output = run_command(cmd, timeout=300)
             return {'output': {'type': 'text', 'content': output}}
         except Exception as e:
             return {'output': {'type': 'error', 'content': str(e)}}
@@ -242,11 +369,11 @@ class MagicHandler:
         """List directory contents"""
         try:
             path = Path(args.strip() or '.').expanduser()
-            items = sorted(path.iterdir(), key=lambda x: (not x.is_dir(), x.name.lower()))
-            lines = []
-            for item in items:
-                prefix = 'd ' if item.is_dir() else 'f '
-                lines.append(f"{prefix}{item.name}")
+            # DirEntry caches the file type from the directory read, so is_dir() is checked once
+            with os.scandir(path) as it:
+                entries = [(entry.name, entry.is_dir()) for entry in it]
+            entries.sort(key=lambda e: (not e[1], e[0].lower()))
+            lines = [f"{'d ' if is_dir else 'f '}{name}" for name, is_dir in entries]
             return {'output': {'type': 'text', 'content': '\n'.join(lines) or '(empty)'}}
         except Exception as e:
             return {'output': {'type': 'error', 'content': str(e)}}
@@ -269,7 +396,8 @@ class MagicHandler:
             if not path.exists():
                 # Try relative to working directory
                 path = kernel.working_dir / args.strip()
-            code = path.read_text()
+            # compile() takes bytes directly and honours PEP 263 coding declarations
+            code = path.read_bytes()
             
             # Execute file code using runpy-like behavior
             stdout_capture = io.StringIO()
@@ -282,7 +410,7 @@ class MagicHandler:
                     '__name__': '__main__',
                     '__file__': str(path),
                 }
-                compiled = compile(code, str(path), 'exec')
+                compiled = _compile(code, str(path), 'exec')
                 exec(compiled, script_globals)
                 # Copy defined variables back to kernel globals (except dunder)
                 for k, v in script_globals.items():
@@ -321,10 +449,16 @@ class MagicHandler:
         """Time code with multiple runs"""
         import timeit
         try:
-            timer = timeit.Timer(code, globals=kernel.globals)
-            # Auto-determine number of runs
+            # Reuse the compiled timing template when the same code is timed again
+            key = (code, id(kernel.globals))
+            timer = _TIMEIT_CACHE.get(key)
+            if timer is None:
+                if len(_TIMEIT_CACHE) >= 64:
+                    _TIMEIT_CACHE.clear()
+                timer = _TIMEIT_CACHE[key] = timeit.Timer(code, globals=kernel.globals)
+            # Auto-determine number of runs (re-calibrated each call, as the data may have changed)
             number, _ = timer.autorange()
-            times = timer.repeat(repeat=3, number=number)
+            times = timer.repeat(repeat=7, number=number)
             best = min(times) / number
             
             if best < 1e-6:
@@ -337,31 +471,24 @@ class MagicHandler:
                 time_str = f"{best:.2f} s"
             
             return {'output': {'type': 'text', 
-                    'content': f"{time_str} ± per loop (mean ± std. dev. of 3 runs, {number} loops each)"}}
+                    'content': f"{time_str} ± per loop (mean ± std. dev. of 7 runs, {number} loops each)"}}
         except Exception as e:
             return {'output': {'type': 'error', 'content': str(e)}}
     
     @staticmethod
     def _who() -> Dict[str, Any]:
         """List variables"""
-        skip = {'__builtins__', '__name__', '__doc__', '__package__', '__file__', 
-                'np', 'pd', 'plt', 'In', 'Out'}
-        names = [n for n in kernel.globals.keys() 
-                 if not n.startswith('_') and n not in skip]
+        names = [name for name, _ in kernel.user_items()]
         return {'output': {'type': 'text', 'content': '  '.join(sorted(names)) or 'No variables defined'}}
     
     @staticmethod
     def _whos() -> Dict[str, Any]:
         """List variables with details"""
-        skip = {'__builtins__', '__name__', '__doc__', '__package__', '__file__',
-                'np', 'pd', 'plt', 'In', 'Out'}
         lines = ['Variable   Type       Data/Info', '-' * 40]
-        for name, value in sorted(kernel.globals.items()):
-            if name.startswith('_') or name in skip:
-                continue
+        for name, value in sorted(kernel.user_items(), key=lambda item: item[0]):
             vtype = type(value).__name__
             try:
-                info = repr(value)[:30]
+                info = summarize_value(value)[:30]
             except:
                 info = '<unable to display>'
             lines.append(f"{name:<10} {vtype:<10} {info}")
@@ -399,13 +526,7 @@ class MagicHandler:
     def _cell_bash(body: str) -> Dict[str, Any]:
         """Execute bash code"""
         try:
-            result = subprocess.run(
-                body, shell=True, capture_output=True, text=True,
-                timeout=120, cwd=str(kernel.working_dir)
-            )
-            output = result.stdout
-            if result.stderr:
-                output += result.stderr
+            output = run_command(body, timeout=120, shell=True, cwd=str(kernel.working_dir))
             return {'output': {'type': 'text', 'content': output or '(no output)'}}
         except subprocess.TimeoutExpired:
             return {'output': {'type': 'error', 'content': 'Command timed out (120s)'}}
@@ -445,6 +566,35 @@ class MagicHandler:
         """Timeit for cell"""
         return MagicHandler._timeit(body)
     
+    @staticmethod
+    def _cell_numba(body: str) -> Dict[str, Any]:
+        """Run the cell, then JIT-compile the functions it defines with numba.njit"""
+        try:
+            import numba
+        except ImportError:
+            return {'output': {'type': 'error', 'content': 'numba is not installed (try %pip install numba)'}}
+        
+        before = dict(kernel.globals)
+        result = execute_python_code(body)
+        if result['output'].get('type') == 'error':
+            return result
+        
+        jitted = []
+        for name, value in list(kernel.globals.items()):
+            # Only functions defined by this cell; imported ones (`from os.path import join`)
+            # are left alone
+            if (isinstance(value, types.FunctionType) and before.get(name) is not value
+                    and value.__code__.co_filename == '<cell>'):
+                # Always a fresh dispatcher: numba freezes global values at compile time,
+                # so re-running the cell must recompile against the current namespace
+                kernel.globals[name] = numba.njit(value)
+                jitted.append(name)
+        
+        content = result['output'].get('content', '')
+        info = f"numba.njit: {', '.join(jitted)}" if jitted else 'numba.njit: no functions defined'
+        result['output']['content'] = f"{content}\n{info}" if content else info
+        return result
+    
     @staticmethod
     def _cell_html(body: str) -> Dict[str, Any]:
         """Return HTML content"""
@@ -461,105 +611,153 @@ class MagicHandler:
         return execute_python_code(body)
 
 
+# Dispatch tables for magics taking a single argument; handlers with other
+# signatures (%time, %timeit, %%writefile) are special-cased above.
+_LINE_MAGICS = {
+    'pip': MagicHandler._pip,
+    'cd': MagicHandler._cd,
+    'pwd': lambda args: MagicHandler._pwd(),
+    'ls': MagicHandler._ls,
+    'cat': MagicHandler._cat,
+    'run': MagicHandler._run,
+    'load': MagicHandler._load,
+    'who': lambda args: MagicHandler._who(),
+    'whos': lambda args: MagicHandler._whos(),
+    'reset': lambda args: MagicHandler._reset(),
+    'env': MagicHandler._env,
+    'matplotlib': MagicHandler._matplotlib,
+}
+
+_CELL_MAGICS = {
+    'bash': MagicHandler._cell_bash,
+    'sh': MagicHandler._cell_bash,
+    'python': MagicHandler._cell_python,
+    'python3': MagicHandler._cell_python,
+    'time': MagicHandler._cell_time,
+    'timeit': MagicHandler._cell_timeit,
+    'html': MagicHandler._cell_html,
+    'javascript': MagicHandler._cell_javascript,
+    'js': MagicHandler._cell_javascript,
+    'capture': MagicHandler._cell_capture,
+    'numba': MagicHandler._cell_numba,
+}
+
+
+_CELL_MAGIC_RE = re.compile(r'^%%(\w+)\s*(.*)?$')
+_LINE_MAGIC_RE = re.compile(r'^%(\w+)\s*(.*)$')
+
+
 def parse_magic(code: str) -> Tuple[Optional[str], Optional[str], Optional[str], str]:
     """
     Parse magic commands from code.
     Returns: (magic_type, magic_name, magic_args, remaining_code)
     magic_type: 'line', 'cell', or None
     """
-    lines = code.split('\n')
-    first_line = lines[0].strip()
+    # Only the first line is needed for detection; avoid splitting the whole cell
+    nl = code.find('\n')
+    first_line = (code if nl < 0 else code[:nl]).strip()
+    if not first_line.startswith('%'):
+        return (None, None, None, code)
+    rest = '' if nl < 0 else code[nl + 1:]
     
     # Cell magic (%%magic)
-    cell_match = re.match(r'^%%(\w+)\s*(.*)?$', first_line)
+    cell_match = _CELL_MAGIC_RE.match(first_line)
     if cell_match:
         magic_name = cell_match.group(1)
         magic_args = cell_match.group(2) or ''
-        body = '\n'.join(lines[1:])
-        return ('cell', magic_name, magic_args, body)
+        return ('cell', magic_name, magic_args, rest)
     
     # Line magic (%magic) - only if it's the entire cell or first line
-    line_match = re.match(r'^%(\w+)\s*(.*)$', first_line)
+    line_match = _LINE_MAGIC_RE.match(first_line)
     if line_match:
         magic_name = line_match.group(1)
         magic_args = line_match.group(2) or ''
-        rest = '\n'.join(lines[1:]) if len(lines) > 1 else ''
         return ('line', magic_name, magic_args, rest)
     
     return (None, None, None, code)
 
 
+@functools.lru_cache(maxsize=512)
+def _compile(source: str, filename: str, mode: str):
+    """Compile source once; re-running an unchanged cell reuses the code object"""
+    return compile(source, filename, mode)
+
+
+_TRAILING_TOKENS = frozenset({tokenize.COMMENT, tokenize.NL, tokenize.NEWLINE,
+                              tokenize.INDENT, tokenize.DEDENT, tokenize.ENDMARKER})
+
+
+def _ends_with_semicolon(source: str) -> bool:
+    """Whether the last code token is ';' (IPython's rule for suppressing display)"""
+    last = None
+    for tok in tokenize.generate_tokens(io.StringIO(source).readline):
+        if tok.type not in _TRAILING_TOKENS:
+            last = tok
+    return last is not None and last.string == ';'
+
+
+@functools.lru_cache(maxsize=512)
+def _compile_cell(source: str):
+    """
+    Compile a cell into (body, last_expr) code objects.
+    last_expr is None unless the final statement is an expression not followed by
+    a semicolon (like IPython).
+    """
+    tree = ast.parse(source, '<cell>', 'exec')
+    last = tree.body[-1] if tree.body else None
+    if not isinstance(last, ast.Expr) or _ends_with_semicolon(source):
+        return compile(tree, '<cell>', 'exec'), None
+    
+    body = ast.Module(body=tree.body[:-1], type_ignores=[])
+    expr = ast.Expression(body=last.value)
+    return compile(body, '<cell>', 'exec'), compile(expr, '<cell>', 'eval')
+
+
+_capture_local = threading.local()
+
+
+def _capture_buffers() -> Tuple[io.StringIO, io.StringIO]:
+    """Per-thread stdout/stderr buffers, emptied for reuse across executions"""
+    bufs = getattr(_capture_local, 'bufs', None)
+    if bufs is None:
+        bufs = _capture_local.bufs = (io.StringIO(), io.StringIO())
+    for buf in bufs:
+        buf.seek(0)
+        buf.truncate()
+    return bufs
+
+
 def execute_python_code(code: str) -> Dict[str, Any]:
     """Execute pure Python code (no magic handling)
     
     Strategy: 
-    1. First try to execute the entire code as exec (handles all Python constructs)
-    2. Capture the result of the last expression WITHOUT re-executing it
-    3. This avoids breaking multi-line constructs like if/for/while blocks
+    1. Parse the cell once and split off the final statement if it is an expression
+    2. Exec the remaining statements, then eval the final expression for display
+    3. Each statement runs exactly once, so calls in the last line have no double side effects
     4. Support multiple outputs (text + plots) like Jupyter
-    
-    IMPORTANT: We must NOT re-eval the last line after exec, because:
-    - Function calls would execute twice (double printing, double side effects)
-    - Only safe to eval pure expressions like variable names, literals, or math
     """
-    stdout_capture = io.StringIO()
-    stderr_capture = io.StringIO()
+    stdout_capture, stderr_capture = _capture_buffers()
     
     result = None
     error_output = None
     
     try:
         with redirect_stdout(stdout_capture), redirect_stderr(stderr_capture):
-            code_lines = code.strip().split('\n')
-            last_line = code_lines[-1].strip() if code_lines else ''
-            
-            # Check if last line is a SAFE expression to eval for result display
-            # Safe means: no function calls, no side effects - just variable lookup or literals
-            is_safe_expr = False
-            
-            if (last_line and 
-                not last_line.startswith('#') and
-                not code_lines[-1].startswith((' ', '\t')) and  # Not indented
-                not last_line.endswith(':') and  # Not a block start
-                '(' not in last_line and  # No function calls!
-                '[' not in last_line and  # No list indexing (could call __getitem__)
-                not last_line.startswith(('if ', 'for ', 'while ', 'def ', 'class ', 'with ', 
-                                         'try:', 'except', 'finally:', 'elif ', 'else:',
-                                         'return ', 'yield ', 'import ', 'from ', 'raise ', 
-                                         'assert ', 'del ', 'pass', 'break', 'continue', 
-                                         'global ', 'nonlocal ')) and
-                not ('=' in last_line and '==' not in last_line and '!=' not in last_line and 
-                     '<=' not in last_line and '>=' not in last_line)):
-                # Try to compile as expression
-                try:
-                    compile(last_line, '<cell>', 'eval')
-                    is_safe_expr = True
-                except SyntaxError:
-                    pass
-            
-            if is_safe_expr:
-                # Execute all but the last line
-                if len(code_lines) > 1:
-                    code_without_last = '\n'.join(code_lines[:-1])
-                    compiled = compile(code_without_last, '<cell>', 'exec')
-                    exec(compiled, kernel.globals)
-                
-                # Eval the last line for result (safe, no side effects)
-                result = eval(compile(last_line, '<cell>', 'eval'), kernel.globals)
-            else:
-                # Execute everything as exec
-                compiled = compile(code, '<cell>', 'exec')
-                exec(compiled, kernel.globals)
+            body, last_expr = _compile_cell(code)
+            exec(body, kernel.globals)
+            if last_expr is not None:
+                result = eval(last_expr, kernel.globals)
         
         # Collect all plots
         plot_images = get_all_plots_as_base64()
         kernel.execution_count += 1
         
     except Exception as e:
+        import traceback
         error_output = traceback.format_exc()
     
     stdout_output = stdout_capture.getvalue()
-    stderr_output = stderr_capture.getvalue()
+    stderr_output = stderr_capture.getvalue() if stderr_capture.tell() else ''
     
     if error_output:
         return {'output': {'type': 'error', 'content': error_output}}
@@ -643,11 +841,7 @@ def execute_code(code: str) -> Dict[str, Any]:
         if cmd.startswith('pip '):
             return MagicHandler._pip(cmd[4:])
         try:
-            result = subprocess.run(
-                cmd, shell=True, capture_output=True, text=True,
-                timeout=120, cwd=str(kernel.working_dir)
-            )
-            output = result.stdout + result.stderr
+            output = run_command(cmd, timeout=120, shell=True, cwd=str(kernel.working_dir))
             kernel.execution_count += 1
             return {'output': {'type': 'text', 'content': output or '(no output)'}}
         except Exception as e:
@@ -671,31 +865,51 @@ def execute_code(code: str) -> Dict[str, Any]:
     return execute_python_code(code)
 
 
+def summarize_value(value: Any) -> str:
+    """Short display string for a variable; skips repr() of large arrays/frames/containers"""
+    if numpy_available and isinstance(value, np.ndarray) and value.size > 100:
+        return f"array(shape={value.shape}, dtype={value.dtype})"
+    if pandas_available and isinstance(value, pd.DataFrame):
+        return f"DataFrame({value.shape[0]}x{value.shape[1]})"
+    if pandas_available and isinstance(value, pd.Series) and len(value) > 100:
+        return f"Series(len={len(value)}, dtype={value.dtype})"
+    if isinstance(value, (list, dict, tuple, set)) and len(value) > 100:
+        return f"{type(value).__name__} len={len(value)}"
+    return repr(value)
+
+
+# type -> (type name, has shape, has len); weak keys so redefined user classes can be freed
+_TYPE_INFO: 'weakref.WeakKeyDictionary[type, Tuple[str, bool, bool]]' = weakref.WeakKeyDictionary()
+
+
+def _type_info(t: type) -> Tuple[str, bool, bool]:
+    """Per-type attributes for the variable inspector, computed once per type"""
+    info = _TYPE_INFO.get(t)
+    if info is None:
+        info = (t.__name__, hasattr(t, 'shape'), hasattr(t, '__len__') and not issubclass(t, str))
+        _TYPE_INFO[t] = info
+    return info
+
+
 def get_variables() -> List[Dict[str, Any]]:
     """Get all user-defined variables"""
-    skip_names = {'__builtins__', '__name__', '__doc__', '__package__', '__file__',
-                  'sys', 'io', 'os', 'base64', 'matplotlib', 'plt', 'json',
-                  'np', 'pd', 'numpy', 'pandas', 'In', 'Out'}
-    
     variables = []
-    for name, value in kernel.globals.items():
-        if name.startswith('_') or name in skip_names:
-            continue
+    for name, value in kernel.user_items(KernelState.INSPECTOR_SKIP_NAMES):
         if callable(value) and not isinstance(value, type):
             continue
         
         try:
-            var_type = type(value).__name__
+            var_type, has_shape, has_len = _type_info(type(value))
             size = None
-            if hasattr(value, 'shape'):
+            if has_shape:
                 size = str(value.shape)
-            elif hasattr(value, '__len__') and not isinstance(value, str):
+            elif has_len:
                 try:
                     size = f"{len(value)} items"
                 except:
                     pass
             
-            val_str = repr(value)
+            val_str = summarize_value(value)
             if len(val_str) > 100:
                 val_str = val_str[:100] + '...'
             
@@ -713,6 +927,124 @@ def get_variables() -> List[Dict[str, Any]]:
 
 # ============== Notebook File Management ==============
 
+# Process umask, read once at import (os.umask can only be queried by setting it)
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+
+
+def atomic_write_bytes(target: Path, data: bytes):
+    """
+    Write data to target atomically and durably: write a temp file in the same
+    directory, fsync it, then rename it over target. Readers never see a torn file.
+    """
+    # Write through symlinks: renaming over the link itself would replace it with a file
+    target = Path(os.path.realpath(target))
+    fd, tmp = tempfile.mkstemp(dir=target.parent, prefix=f'.{target.name}.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            try:
+                mode = stat.S_IMODE(target.stat().st_mode)
+            except FileNotFoundError:
+                mode = 0o666 & ~_UMASK
+            if hasattr(os, 'fchmod'):
+                os.fchmod(f.fileno(), mode)  # mkstemp creates files as 0600
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, target)
+    except BaseException:
+        try:
+            os.unlink(tmp)
+        except OSError:
+            pass
+        raise
+
+
+class WriteCoalescer:
+    """
+    Group commit for whole-file writes. Concurrent writes to the same path collapse
+    into one atomic write of the newest payload; every caller returns once data at
+    least as new as its own is on disk. Saves that pile up behind a slow fsync
+    (e.g. autosaves from several collaborators) cost one write instead of N.
+    """
+    
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._states: Dict[Path, Dict[str, Any]] = {}
+    
+    def write(self, target: Path, data: bytes):
+        with self._cond:
+            state = self._states.get(target)
+            if state is None:
+                state = self._states[target] = {'gen': 0, 'written': 0, 'data': None,
+                                                'writing': False, 'waiters': 0}
+            state['gen'] += 1
+            state['data'] = data
+            my_gen = state['gen']
+            state['waiters'] += 1
+            try:
+                while state['written'] < my_gen:
+                    if state['writing']:
+                        self._cond.wait()
+                        continue
+                    # Become the writer for everything queued so far
+                    gen, payload = state['gen'], state['data']
+                    state['writing'] = True
+                    self._cond.release()
+                    try:
+                        atomic_write_bytes(target, payload)
+                    finally:
+                        self._cond.acquire()
+                        state['writing'] = False
+                        self._cond.notify_all()
+                    state['written'] = gen
+            finally:
+                state['waiters'] -= 1
+                if state['waiters'] == 0 and not state['writing']:
+                    del self._states[target]
+
+
+_writer = WriteCoalescer()
+
+
+def _dumps_notebook(nb: dict) -> bytes:
+    """Serialize a notebook to indented JSON bytes (orjson when available)"""
+    if orjson_available:
+        return orjson.dumps(nb, option=orjson.OPT_INDENT_2)
+    return json.dumps(nb, indent=2).encode('utf-8')
+
+
+def _loads_notebook(raw: bytes) -> dict:
+    """Parse notebook JSON bytes (orjson when available)"""
+    if orjson_available:
+        return orjson.loads(raw)
+    return json.loads(raw)
+
+
+def notebook_stat(name: str) -> os.stat_result:
+    """stat() a file in NOTEBOOKS_DIR by name"""
+    if NOTEBOOKS_DIR_FD is None:
+        return (NOTEBOOKS_DIR / name).stat()
+    return os.stat(name, dir_fd=NOTEBOOKS_DIR_FD)
+
+
+def read_notebook_bytes(name: str) -> bytes:
+    """Read a file in NOTEBOOKS_DIR by name (raises FileNotFoundError if missing)"""
+    if NOTEBOOKS_DIR_FD is None:
+        return (NOTEBOOKS_DIR / name).read_bytes()
+    fd = os.open(name, os.O_RDONLY, dir_fd=NOTEBOOKS_DIR_FD)
+    with open(fd, 'rb') as f:
+        return f.read()
+
+
+def unlink_notebook(name: str):
+    """Remove a file in NOTEBOOKS_DIR by name (raises FileNotFoundError if missing)"""
+    if NOTEBOOKS_DIR_FD is None:
+        (NOTEBOOKS_DIR / name).unlink()
+    else:
+        os.unlink(name, dir_fd=NOTEBOOKS_DIR_FD)
+
+
 def save_notebook_file(notebook_id: str, data: dict) -> Path:
     """Save notebook to .ipynb file"""
     filepath = NOTEBOOKS_DIR / f"{notebook_id}.ipynb"
@@ -743,7 +1075,7 @@ def save_notebook_file(notebook_id: str, data: dict) -> Path:
             "cell_type": cell.get('type', 'code'),
             # Preserve stable cell ids for collaboration/state sync.
             "metadata": {"id": cell.get('id')} if cell.get('id') else {},
-            "source": cell.get('content', '').split('\n'),
+            "source": cell.get('content', ''),
         }
         if cell.get('type') == 'code':
             nb_cell["execution_count"] = cell.get('executionCount')
@@ -767,23 +1099,39 @@ def save_notebook_file(notebook_id: str, data: dict) -> Path:
                     nb_cell["outputs"].append({
                         "output_type": "stream",
                         "name": "stdout",
-                        "text": output.get('content', '').split('\n')
+                        "text": output.get('content', '')
                     })
         
         nb["cells"].append(nb_cell)
     
-    filepath.write_text(json.dumps(nb, indent=2))
+    _writer.write(filepath, _dumps_notebook(nb))
+    invalidate_notebook_list()
     return filepath
 
 
+def _join_multiline(value) -> str:
+    """
+    Join an nbformat multiline string (str or list of lines) into one string.
+    nbformat lists keep each line's trailing newline; older notebooks saved by this
+    server stored lines without them, so those are joined with newlines instead.
+    """
+    if not isinstance(value, list):
+        return value
+    if len(value) > 1 and not value[0].endswith('\n'):
+        return '\n'.join(value)
+    return ''.join(value)
+
+
 def load_notebook_file(notebook_id: str) -> Optional[dict]:
     """Load notebook from .ipynb file"""
     filepath = NOTEBOOKS_DIR / f"{notebook_id}.ipynb"
-    if not filepath.exists():
+    try:
+        raw = read_notebook_bytes(filepath.name)
+    except FileNotFoundError:
         return None
     
     try:
-        nb = json.loads(filepath.read_text())
+        nb = _loads_notebook(raw)
 
         used_ids = set()
         migrated = False
@@ -821,7 +1169,7 @@ def load_notebook_file(notebook_id: str) -> Optional[dict]:
             cell = {
                 'id': cell_id,
                 'type': nb_cell.get('cell_type', 'code'),
-                'content': '\n'.join(nb_cell.get('source', [])) if isinstance(nb_cell.get('source'), list) else nb_cell.get('source', ''),
+                'content': _join_multiline(nb_cell.get('source', '')),
                 'status': 'idle',
             }
             if nb_cell.get('execution_count'):
@@ -843,17 +1191,16 @@ def load_notebook_file(notebook_id: str) -> Optional[dict]:
                         'data': out.get('data', {})
                     }
                 else:
-                    text = out.get('text', [])
                     cell['output'] = {
                         'type': 'text',
-                        'content': '\n'.join(text) if isinstance(text, list) else text
+                        'content': _join_multiline(out.get('text', ''))
                     }
             
             cells.append(cell)
 
         if migrated:
             try:
-                filepath.write_text(json.dumps(nb, indent=2))
+                atomic_write_bytes(filepath, _dumps_notebook(nb))
             except Exception as e:
                 print(f"Warning: failed to persist migrated cell ids: {e}")
         
@@ -869,26 +1216,197 @@ def load_notebook_file(notebook_id: str) -> Optional[dict]:
         return None
 
 
-def list_notebooks() -> List[dict]:
-    """List all saved notebooks"""
+# Listing metadata per notebook file, keyed by path -> ((st_mtime_ns, st_size), entry)
+_NB_META_CACHE: Dict[Path, Tuple[Tuple[int, int], dict]] = {}
+
+
+def _scan_notebooks() -> List[dict]:
+    """Scan NOTEBOOKS_DIR (only files changed since the last scan are re-parsed)"""
     notebooks = []
-    for filepath in NOTEBOOKS_DIR.glob('*.ipynb'):
+    seen = set()
+    with os.scandir(NOTEBOOKS_DIR) as it:
+        entries = [entry for entry in it if entry.name.endswith('.ipynb')]
+    for entry in entries:
+        filepath = Path(entry.path)
         try:
-            nb = json.loads(filepath.read_text())
+            st = entry.stat()
+            key = (st.st_mtime_ns, st.st_size)
+            seen.add(filepath)
+            cached = _NB_META_CACHE.get(filepath)
+            if cached and cached[0] == key:
+                notebooks.append(cached[1])
+                continue
+            
+            nb = _loads_notebook(read_notebook_bytes(entry.name))
             meta = nb.get('metadata', {})
-            notebooks.append({
+            info = {
                 'id': filepath.stem,
                 'title': meta.get('title', filepath.stem),
                 'modified': meta.get('modified', ''),
                 'created': meta.get('created', '')
-            })
+            }
+            _NB_META_CACHE[filepath] = (key, info)
+            notebooks.append(info)
         except:
             pass
+    
+    # Drop entries for notebooks that no longer exist
+    for stale in _NB_META_CACHE.keys() - seen:
+        _NB_META_CACHE.pop(stale, None)
+    
     return sorted(notebooks, key=lambda x: x.get('modified', ''), reverse=True)
 
 
+# Sorted listing reused while inotify reports no change in NOTEBOOKS_DIR
+_notebook_list: Optional[List[dict]] = None
+_notebooks_dirty = threading.Event()
+_notebooks_dirty.set()
+_notebook_watcher_started = False
+_notebook_watcher_active = False
+_notebook_watcher_lock = threading.Lock()
+
+
+def _watch_notebooks_dir(inotify):
+    """Background loop: mark the listing dirty whenever NOTEBOOKS_DIR changes"""
+    global _notebook_watcher_active
+    try:
+        while True:
+            if inotify.read():
+                _notebooks_dirty.set()
+    except Exception as e:
+        print(f"Warning: notebook directory watcher stopped: {e}")
+    finally:
+        _notebook_watcher_active = False
+        _notebooks_dirty.set()
+
+
+def _start_notebook_watcher():
+    """Start the inotify watcher once; without inotify_simple (non-Linux) every call rescans"""
+    global _notebook_watcher_started, _notebook_watcher_active
+    with _notebook_watcher_lock:
+        if _notebook_watcher_started:
+            return
+        _notebook_watcher_started = True
+        try:
+            from inotify_simple import INotify, flags
+            inotify = INotify()
+            inotify.add_watch(NOTEBOOKS_DIR, flags.CREATE | flags.DELETE | flags.MODIFY |
+                              flags.MOVED_FROM | flags.MOVED_TO | flags.DELETE_SELF)
+        except (ImportError, OSError):
+            return
+        _notebook_watcher_active = True
+        threading.Thread(target=_watch_notebooks_dir, args=(inotify,), daemon=True,
+                         name='notebook-watcher').start()
+
+
+def invalidate_notebook_list():
+    """Force the next list_notebooks() to rescan (for changes made by this process)"""
+    _notebooks_dirty.set()
+    bump_generation('notebooks')
+
+
+def list_notebooks() -> List[dict]:
+    """List all saved notebooks"""
+    global _notebook_list
+    _start_notebook_watcher()
+    if _notebook_watcher_active and not _notebooks_dirty.is_set() and _notebook_list is not None:
+        return _notebook_list
+    
+    # Clear before scanning so changes made during the scan mark it dirty again
+    _notebooks_dirty.clear()
+    _notebook_list = _scan_notebooks()
+    return _notebook_list
+
+
 # ============== API Routes ==============
 
+# Encoded GET /notebooks/<id> bodies, least recently used first:
+# notebook_id -> {'etag': file etag, 'body': JSON bytes, 'zstd': compressed body or None}
+NB_RESPONSE_CACHE_SIZE = 64
+_NB_RESPONSE_CACHE: 'OrderedDict[str, Dict[str, Any]]' = OrderedDict()
+_nb_response_lock = threading.Lock()
+
+
+def workspace_path(path: str) -> Path:
+    """
+    Join path onto the kernel working directory and check it stays inside it.
+    Purely lexical (normpath), so no per-component stat/readlink like Path.resolve().
+    """
+    root = os.path.abspath(kernel.working_dir)
+    full = os.path.normpath(os.path.join(root, path))
+    if full != root and not full.startswith(root.rstrip(os.sep) + os.sep):
+        raise ValueError(f'Path is outside the working directory: {path}')
+    return Path(full)
+
+
+def request_json() -> Any:
+    """
+    Parse the JSON request body (via app.json, i.e. orjson when available).
+    Unlike request.get_json(), the raw body isn't cached on the request, so a large
+    notebook save isn't held twice; returns None for an empty or invalid body.
+    """
+    raw = request.get_data(cache=False)
+    if not raw:
+        return None
+    try:
+        return app.json.loads(raw)
+    except ValueError:
+        return None
+
+
+def notebook_etag(notebook_id: str) -> Optional[str]:
+    """Validator derived from a notebook's mtime and size, or None if it doesn't exist"""
+    try:
+        st = notebook_stat(f"{notebook_id}.ipynb")
+    except OSError:
+        return None
+    return f"{st.st_mtime_ns:x}-{st.st_size:x}"
+
+
+# key -> (generation the run started at, its result); key -> generation
+_inflight: Dict[str, Tuple[int, Future]] = {}
+_generations: Dict[str, int] = {}
+_inflight_lock = threading.Lock()
+
+
+def bump_generation(key: str):
+    """Mark data behind key as changed: callers arriving later won't join runs started before"""
+    with _inflight_lock:
+        _generations[key] = _generations.get(key, 0) + 1
+
+
+def coalesced(key: str, fn):
+    """
+    Run fn(), sharing its result with concurrent callers using the same key (idempotent
+    reads only). A caller only joins a run started at or after the generation it saw on
+    arrival, so it never gets a result from before its own earlier writes.
+    """
+    with _inflight_lock:
+        generation = _generations.get(key, 0)
+        entry = _inflight.get(key)
+        owner = entry is None or entry[0] < generation
+        if owner:
+            entry = _inflight[key] = (generation, Future())
+    future = entry[1]
+    
+    if owner:
+        try:
+            value = fn()
+        except BaseException as e:
+            with _inflight_lock:
+                if _inflight.get(key) is entry:
+                    del _inflight[key]
+            future.set_exception(e)
+            raise
+        with _inflight_lock:
+            if _inflight.get(key) is entry:
+                del _inflight[key]
+        future.set_result(value)
+        return value
+    
+    return future.result()
+
+
 @app.route('/health', methods=['GET'])
 def health():
     """Health check endpoint"""
@@ -905,7 +1423,7 @@ def health():
             'pandas': pandas_available,
             'pip_install': True,
             'shell_commands': True,
-            'cell_magics': ['%%bash', '%%python', '%%writefile', '%%time', '%%timeit', '%%html'],
+            'cell_magics': ['%%bash', '%%python', '%%writefile', '%%time', '%%timeit', '%%html', '%%numba'],
             'line_magics': ['%pip', '%cd', '%pwd', '%ls', '%run', '%time', '%timeit', '%who', '%whos', '%env'],
             'notebook_storage': True
         }
@@ -915,24 +1433,27 @@ def health():
 @app.route('/execute', methods=['POST'])
 def execute():
     """Execute Python code"""
-    data = request.get_json()
+    data = request_json()
     if not data or 'code' not in data:
         return jsonify({'error': 'No code provided'}), 400
     
-    result = execute_code(data['code'])
+    with kernel.executing():
+        result = execute_code(data['code'])
+    bump_generation('variables')
     return jsonify(result)
 
 
 @app.route('/variables', methods=['GET'])
 def variables():
     """Get current variables"""
-    return jsonify({'variables': get_variables()})
+    return jsonify({'variables': coalesced('variables', get_variables)})
 
 
 @app.route('/restart', methods=['POST'])
 def restart():
     """Restart the kernel"""
     kernel.reset()
+    bump_generation('variables')
     return jsonify({'ok': True})
 
 
@@ -946,22 +1467,77 @@ def interrupt():
 @app.route('/notebooks', methods=['GET'])
 def get_notebooks():
     """List all notebooks"""
-    return jsonify({'notebooks': list_notebooks()})
+    return jsonify({'notebooks': coalesced('notebooks', list_notebooks)})
+
+
+# One rule per path, dispatching on method, keeps the URL map small on hot routes
+@app.route('/notebooks/<notebook_id>', methods=['GET', 'PUT', 'POST', 'DELETE'])
+def notebook_endpoint(notebook_id):
+    """Get, save or delete a notebook"""
+    # Writes are named explicitly: Werkzeug also routes HEAD here, and it must read
+    if request.method in ('PUT', 'POST'):
+        return save_notebook(notebook_id)
+    if request.method == 'DELETE':
+        return delete_notebook(notebook_id)
+    return get_notebook(notebook_id)
 
 
-@app.route('/notebooks/<notebook_id>', methods=['GET'])
 def get_notebook(notebook_id):
     """Get a specific notebook"""
-    nb = load_notebook_file(notebook_id)
-    if nb:
-        return jsonify({'notebook': nb})
-    return jsonify({'error': 'Notebook not found'}), 404
+    # Revalidation of an unchanged notebook is answered from stat() alone, without parsing
+    etag = notebook_etag(notebook_id)
+    if etag:
+        # Compressed bodies carry their own tags: ':gzip' from Flask-Compress, ':zstd' below
+        for tag in (etag, f"{etag}:gzip", f"{etag}:zstd"):
+            if request.if_none_match.contains(tag):
+                response = Response(status=304)
+                response.set_etag(tag)
+                return response
+    
+    entry = None
+    with _nb_response_lock:
+        cached = _NB_RESPONSE_CACHE.get(notebook_id)
+        if etag and cached and cached['etag'] == etag:
+            _NB_RESPONSE_CACHE.move_to_end(notebook_id)
+            entry = cached
+    
+    if entry is None:
+        nb = load_notebook_file(notebook_id)
+        if not nb:
+            return jsonify({'error': 'Notebook not found'}), 404
+        entry = {'etag': None, 'body': jsonify({'notebook': nb}).get_data(), 'zstd': None}
+        # The body matches the tag only if the file didn't change while it was read (a
+        # concurrent save, or cell ids migrated by the load); otherwise send it untagged
+        if notebook_etag(notebook_id) != etag:
+            etag = None
+        entry['etag'] = etag
+        if etag:
+            with _nb_response_lock:
+                _NB_RESPONSE_CACHE[notebook_id] = entry
+                _NB_RESPONSE_CACHE.move_to_end(notebook_id)
+                while len(_NB_RESPONSE_CACHE) > NB_RESPONSE_CACHE_SIZE:
+                    _NB_RESPONSE_CACHE.popitem(last=False)
+    
+    if zstandard_available and request.accept_encodings['zstd']:
+        # Compressed once per notebook version, then reused for every zstd-capable client
+        if entry['zstd'] is None:
+            entry['zstd'] = zstandard.ZstdCompressor(level=3).compress(entry['body'])
+        response = Response(entry['zstd'], mimetype='application/json')
+        response.headers['Content-Encoding'] = 'zstd'
+        tag = etag and f"{etag}:zstd"
+    else:
+        response = Response(entry['body'], mimetype='application/json')
+        tag = etag
+    response.vary.add('Accept-Encoding')
+    if tag:
+        response.set_etag(tag)
+        response.headers['Cache-Control'] = 'no-cache'
+    return response
 
 
-@app.route('/notebooks/<notebook_id>', methods=['PUT', 'POST'])
 def save_notebook(notebook_id):
     """Save a notebook"""
-    data = request.get_json()
+    data = request_json()
     if not data:
         return jsonify({'error': 'No data provided'}), 400
     
@@ -973,14 +1549,16 @@ def save_notebook(notebook_id):
     })
 
 
-@app.route('/notebooks/<notebook_id>', methods=['DELETE'])
 def delete_notebook(notebook_id):
     """Delete a notebook"""
-    filepath = NOTEBOOKS_DIR / f"{notebook_id}.ipynb"
-    if filepath.exists():
-        filepath.unlink()
-        return jsonify({'ok': True})
-    return jsonify({'error': 'Notebook not found'}), 404
+    try:
+        unlink_notebook(f"{notebook_id}.ipynb")
+    except FileNotFoundError:
+        return jsonify({'error': 'Notebook not found'}), 404
+    invalidate_notebook_list()
+    with _nb_response_lock:
+        _NB_RESPONSE_CACHE.pop(notebook_id, None)
+    return jsonify({'ok': True})
 
 
 @app.route('/notebooks/<notebook_id>/download', methods=['GET'])
@@ -988,7 +1566,10 @@ def download_notebook(notebook_id):
     """Download notebook as .ipynb file"""
     filepath = NOTEBOOKS_DIR / f"{notebook_id}.ipynb"
     if filepath.exists():
-        return send_file(filepath, as_attachment=True, download_name=f"{notebook_id}.ipynb")
+        # send_file hands the open file to the server's wsgi.file_wrapper (sendfile under
+        # waitress/gunicorn) or, with USE_X_SENDFILE=1, to the reverse proxy
+        return send_file(filepath, mimetype='application/x-ipynb+json',
+                         as_attachment=True, download_name=f"{notebook_id}.ipynb")
     return jsonify({'error': 'Notebook not found'}), 404
 
 
@@ -997,83 +1578,222 @@ def list_files():
     """List files in working directory"""
     path = request.args.get('path', '.')
     try:
-        target = (kernel.working_dir / path).resolve()
-        items = []
-        for item in sorted(target.iterdir(), key=lambda x: (not x.is_dir(), x.name.lower())):
-            items.append({
-                'name': item.name,
-                'type': 'directory' if item.is_dir() else 'file',
-                'size': item.stat().st_size if item.is_file() else None,
-                'modified': datetime.fromtimestamp(item.stat().st_mtime).isoformat()
-            })
-        return jsonify({
-            'path': str(target),
-            'items': items
-        })
+        target = workspace_path(path)
+        with os.scandir(target) as it:
+            entries = sorted(it, key=lambda e: (not e.is_dir(), e.name.lower()))
     except Exception as e:
         return jsonify({'error': str(e)}), 400
+    
+    def generate():
+        # Stream items as they are stat'ed instead of building the whole list first
+        yield '{"path": ' + app.json.dumps(str(target)) + ', "items": ['
+        first = True
+        for entry in entries:
+            try:
+                # One stat per entry (cached on the DirEntry); the type comes from its st_mode
+                st = entry.stat()
+            except OSError:
+                continue  # Removed since the directory was read
+            item = {
+                'name': entry.name,
+                'type': 'directory' if stat.S_ISDIR(st.st_mode) else 'file',
+                'size': st.st_size if stat.S_ISREG(st.st_mode) else None,
+                # Unix seconds; clients format it, sparing a datetime per entry here
+                'modified': st.st_mtime
+            }
+            yield ('' if first else ', ') + app.json.dumps(item)
+            first = False
+        yield ']}'
+    
+    return Response(generate(), mimetype='application/json')
+
+
+# Files larger than this are streamed by read_file instead of loaded whole
+FILE_STREAM_THRESHOLD = 1 << 20
+# Multiple of 3, so base64 of consecutive chunks concatenates without padding
+_FILE_STREAM_CHUNK = 48 * 1024
+
+
+def _iter_file_chunks(path: Path):
+    with path.open('rb') as f:
+        for chunk in iter(lambda: f.read(_FILE_STREAM_CHUNK), b''):
+            yield chunk
+
+
+def _is_utf8_file(path: Path) -> bool:
+    """Validate a file as UTF-8 chunk by chunk, without holding it in memory"""
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    try:
+        for chunk in _iter_file_chunks(path):
+            decoder.decode(chunk)
+        decoder.decode(b'', final=True)
+    except UnicodeDecodeError:
+        return False
+    return True
+
+
+def _stream_file_json(path: Path, binary: bool):
+    """Yield the read_file JSON document for path, encoding the content chunk by chunk"""
+    yield '{"path": ' + app.json.dumps(str(path)) + (', "binary": true' if binary else '')
+    yield ', "content": "'
+    if binary:
+        for chunk in _iter_file_chunks(path):
+            yield b64encode_str(chunk)
+    else:
+        # Universal newlines, like the read_text() used for smaller files
+        decoder = io.IncrementalNewlineDecoder(codecs.getincrementaldecoder('utf-8')(), translate=True)
+        for chunk in _iter_file_chunks(path):
+            text = decoder.decode(chunk)
+            if text:
+                yield app.json.dumps(text)[1:-1]  # Escaped string body without the quotes
+        text = decoder.decode(b'', final=True)  # A trailing '\r' is held back until here
+        if text:
+            yield app.json.dumps(text)[1:-1]
+    yield '"}'
+
+
+@app.route('/files/<path:filepath>', methods=['GET', 'PUT', 'POST'])
+def file_endpoint(filepath):
+    """Read or write a file"""
+    if request.method in ('PUT', 'POST'):
+        return write_file(filepath)
+    return read_file(filepath)
 
 
-@app.route('/files/<path:filepath>', methods=['GET'])
 def read_file(filepath):
     """Read a file"""
     try:
-        target = (kernel.working_dir / filepath).resolve()
+        target = workspace_path(filepath)
         if target.is_file():
+            if request.args.get('raw') == '1':
+                # Raw bytes for downloads/previews; conditional GET answers 304 on cache hits
+                return send_file(target, conditional=True, etag=True)
+            
+            if target.stat().st_size > FILE_STREAM_THRESHOLD:
+                # The text/binary decision must be made before the first byte is sent
+                binary = not _is_utf8_file(target)
+                return Response(_stream_file_json(target, binary), mimetype='application/json')
+            
             # Check if it's a text file
             try:
                 content = target.read_text()
                 return jsonify({'content': content, 'path': str(target)})
             except:
                 # Binary file - return base64
-                content = base64.b64encode(target.read_bytes()).decode()
+                content = b64encode_str(target.read_bytes())
                 return jsonify({'content': content, 'path': str(target), 'binary': True})
         return jsonify({'error': 'Not a file'}), 400
     except Exception as e:
         return jsonify({'error': str(e)}), 400
 
 
-@app.route('/files/<path:filepath>', methods=['PUT', 'POST'])
 def write_file(filepath):
     """Write to a file"""
-    data = request.get_json()
+    data = request_json()
     if not data or 'content' not in data:
         return jsonify({'error': 'No content provided'}), 400
     
     try:
-        target = (kernel.working_dir / filepath).resolve()
-        target.parent.mkdir(parents=True, exist_ok=True)
-        target.write_text(data['content'])
+        target = workspace_path(filepath)
+        content = data['content'].encode('utf-8')
+        try:
+            _writer.write(target, content)
+        except FileNotFoundError:
+            # Parent directories are only created when missing, not on every write
+            target.parent.mkdir(parents=True, exist_ok=True)
+            _writer.write(target, content)
         return jsonify({'ok': True, 'path': str(target)})
     except Exception as e:
         return jsonify({'error': str(e)}), 400
 
 
-@app.route('/cwd', methods=['GET'])
+@app.route('/cwd', methods=['GET', 'POST'])
+def cwd_endpoint():
+    """Get or set the current working directory"""
+    if request.method == 'POST':
+        return set_cwd()
+    return get_cwd()
+
+
 def get_cwd():
     """Get current working directory"""
     return jsonify({'cwd': str(kernel.working_dir)})
 
 
-@app.route('/cwd', methods=['POST'])
 def set_cwd():
     """Set current working directory"""
-    data = request.get_json()
+    data = request_json() or {}
     path = data.get('path', '')
     if kernel.set_working_dir(path):
         return jsonify({'ok': True, 'cwd': str(kernel.working_dir)})
     return jsonify({'error': 'Invalid path'}), 400
 
 
+# ASGI entry point for servers implementing the http.response.pathsend extension (e.g.
+# granian; uvicorn does not). Notebook downloads skip the WSGI bridge and are handed to
+# the server as a path, so the file goes out in a single sendfile() instead of chunks
+# copied through Python. Still run one worker.
+try:
+    from asgiref.sync import sync_to_async
+    from asgiref.wsgi import WsgiToAsgiInstance
+    asgi_available = True
+except ImportError:
+    asgi_available = False
+
+_DOWNLOAD_PATH_RE = re.compile(r'^/notebooks/([\w.-]+)/download$')
+
+if asgi_available:
+    class _PooledWsgiToAsgiInstance(WsgiToAsgiInstance):
+        """WSGI bridge running each request on the loop's thread pool"""
+        
+        # asgiref's default is thread_sensitive, i.e. every request on one shared thread,
+        # which would queue /health and friends behind a running cell
+        run_wsgi_app = sync_to_async(WsgiToAsgiInstance.run_wsgi_app.__wrapped__,
+                                     thread_sensitive=False)
+    
+    async def asgi_app(scope, receive, send):
+        """Serve notebook downloads via pathsend where supported; everything else goes to Flask"""
+        if scope['type'] == 'http' and scope['method'] == 'GET' \
+                and 'http.response.pathsend' in scope.get('extensions', {}):
+            match = _DOWNLOAD_PATH_RE.match(scope['path'])
+            if match:
+                name = f"{match.group(1)}.ipynb"
+                try:
+                    st = notebook_stat(name)
+                except OSError:
+                    st = None
+                if st is not None:
+                    await send({
+                        'type': 'http.response.start',
+                        'status': 200,
+                        'headers': [
+                            (b'content-type', b'application/x-ipynb+json'),
+                            (b'content-length', str(st.st_size).encode()),
+                            (b'content-disposition', f'attachment; filename={name}'.encode()),
+                        ],
+                    })
+                    await send({'type': 'http.response.pathsend', 'path': str(NOTEBOOKS_DIR / name)})
+                    return
+        # Missing notebooks, servers without pathsend and all other routes
+        await _PooledWsgiToAsgiInstance(app)(scope, receive, send)
+
+
 if __name__ == '__main__':
     import argparse
     parser = argparse.ArgumentParser(description='Jupyter-ish Kernel Server')
     parser.add_argument('--port', type=int, default=5000, help='Port to run on')
     parser.add_argument('--host', type=str, default='0.0.0.0', help='Host to bind to')
+    parser.add_argument('--threads', type=int, default=8, help='Worker threads (waitress only)')
     args = parser.parse_args()
     
     print(f"Starting Jupyter-ish Kernel Server on {args.host}:{args.port}")
     print(f"Working directory: {kernel.working_dir}")
     print(f"Notebooks directory: {NOTEBOOKS_DIR}")
     print(f"Features: matplotlib={matplotlib_available}, numpy={numpy_available}, pandas={pandas_available}")
-    app.run(host=args.host, port=args.port, debug=False, threaded=True)
+    try:
+        from waitress import serve
+    except ImportError:
+        print("waitress not installed, using the Flask development server")
+        app.run(host=args.host, port=args.port, debug=False, threaded=True)
+    else:
+        serve(app, host=args.host, port=args.port, threads=args.threads)
@@ -153,7 +153,8 @@ export async function listBackendFiles(path: string = '.'): Promise<{
     name: string;
     type: 'file' | 'directory';
     size: number | null;
-    modified: string;
+    /** Modification time in Unix seconds */
+    modified: number;
   }>;
 }> {
   return fetchBackend(`/files?path=${encodeURIComponent(path)}`);